@@ -6,6 +6,13 @@ import dateutil.parser
 import json
 import threading
 import random
+import time
+import contextlib
+import collections
+import array
+import asyncio
+import functools
+import concurrent.futures
 
 from possumtypes import *
 
@@ -13,6 +20,42 @@ from possumtypes import *
 def KeyFromValue(ls, value):
 	return ls.keys()[ls.values().index(value)]
 
+# *********************************************************************
+# Bounded LRU map of (table, id) to the row last loaded for it. Used 
+# by DB as an identity map so that ModelBase.Load() of the same object 
+# does not have to go back to the database.
+class RowCache(object):
+	
+	# -------------------------------------------------------------------
+	def __init__(self, size):
+		self.size	=	size
+		self.rows	=	collections.OrderedDict()
+		
+	# -------------------------------------------------------------------
+	def Get(self, key):
+		r	=	self.rows.get(key)
+		
+		if r != None:
+			self.rows.move_to_end(key)
+			
+		return r
+		
+	# -------------------------------------------------------------------
+	def Set(self, key, row):
+		self.rows[key]	=	row
+		self.rows.move_to_end(key)
+		
+		while len(self.rows) > self.size:
+			self.rows.popitem(last = False)
+		
+	# -------------------------------------------------------------------
+	def Remove(self, key):
+		self.rows.pop(key, None)
+		
+	# -------------------------------------------------------------------
+	def Clear(self):
+		self.rows.clear()
+
 # *********************************************************************
 class DB(object):
 	
@@ -26,86 +69,237 @@ class DB(object):
 		'POSTGRESQL':	3,
 	}
 	
-	CONNECTIONS	=	{}
-	DEFAULTCONN	=	None
+	# Each thread has its own current connection in LOCAL.conn, which
+	# ModelBase uses when an object was not given a connection. Threads
+	# without one get theirs from DEFAULTPOOL.
+	LOCAL				=	threading.local()
+	DEFAULTPOOL	=	None
 	DEFAULTFILE	=	None
 	
+	# Number of compiled statements sqlite3 keeps per connection
+	CACHEDSTATEMENTS	=	256
+	
+	# Rows fetched at a time by IterQuery()
+	FETCHSIZE	=	500
+	
+	# Ids bound to each statement by ModelBase.DeleteMany()
+	DELETESIZE	=	500
+	
+	# Relies on the unique dbconfig_key index. ON CONFLICT DO UPDATE would
+	# need SQLite 3.24, which older Raspbian releases do not have.
+	CONFIGUPSERT	=	"INSERT OR REPLACE INTO dbconfig(key, value) VALUES(?, ?)"
+	
+	# PRAGMA settings which can be chosen by name with the profile
+	# argument. 'performance' uses WAL so that readers are not blocked
+	# by a writer in another process, and only syncs at checkpoints.
+	PROFILES	=	{
+		'default':			{},
+		'performance':	{
+			'journal_mode':	'WAL',
+			'synchronous':	'NORMAL',
+			'temp_store':		'MEMORY',
+			'cache_size':		-65536,
+			'mmap_size':		268435456,
+		},
+	}
+	
+	# Indexes on the internal tables as name: (table, columns[, 'UNIQUE']).
+	# links_reverse covers Linked() from the higher type's side, which
+	# the primary key cannot serve, and links_forward lets the other
+	# direction be read in num order without touching the table.
+	INDEXES	=	{
+		'links_forward':				('links',					'type1, id1, type2, type, num, id2'),
+		'links_reverse':				('links',					'type2, id2, type1, type, num, id1'),
+		'translations_textid':	('translations',	'textid, language'),
+		'dbconfig_key':					('dbconfig',			'key',	'UNIQUE'),
+	}
+	
 	# ----------------------------------------------------------------------------------------
 	def __init__(self, 
 			connectionname	=	None,
 			dbname					=	None, 
 			dbtype 					= 'SQLITE',
 			username				=	None,
-			password				=	None
+			password				=	None,
+			cachesize				=	0,
+			profile					=	None,
+			checksamethread	=	True,
+			register				=	True
 		):
 		if not connectionname and not dbname:
 			connectionname	=	'default'
 			dbname					=	DB.DEFAULTFILE
 		
 		if dbtype == 'SQLITE':
-			self.dbconn	=	sqlite3.connect(dbname, 30)
+			self.dbconn	=	sqlite3.connect(
+				dbname, 
+				30, 
+				cached_statements	=	DB.CACHEDSTATEMENTS, 
+				check_same_thread	=	checksamethread
+			)
 			self.dbconn.row_factory = sqlite3.Row
 			self.dbconn.execute("PRAGMA busy_timeout = 15000")
 		else:
 			raise Exception('Database type {} not supported'.format(dbtype))
 		
+		if profile:
+			self.SetPragmas(DB.PROFILES[profile] if isinstance(profile, str) else profile)
+		
 		self.debug		=	False
 		self.language	=	1
 		self.objtypes	=	{}
+		self.typeids	=	{}
 		self.cursor		=	self.dbconn.cursor()
+		self.rowcache	=	None
 		
-		self.connectionname	=	connectionname
+		self.typesloaded	=	False
+		self.typeslock		=	threading.Lock()
+		
+		self.translations	=	{}
+		self.preloaded		=	set()
+		
+		self.config					=	None
+		self.configwrites		=	{}
+		self.deferconfig		=	False
+		
+		self.writebehind	=	None
+		self.writequeue		=	collections.OrderedDict()
+		self.queuetime		=	0
+		
+		# Set while a transaction opened by Begin() is in progress
+		self.begun			=	False
+		self.savepoints	=	0
+		
+		# Objects written since the last commit with their id and saved
+		# values from before, so that a rollback can put them back
+		self.undo	=	[]
 		
-		DB.CONNECTIONS[connectionname]	=	(dbname, dbtype, self)
+		self.SetCacheSize(cachesize)
 		
-		if not DB.DEFAULTCONN:
-			DB.DEFAULTCONN	=	self
+		self.connectionname	=	connectionname
+		
+		if register and not getattr(DB.LOCAL, 'conn', None):
+			DB.LOCAL.conn	=	self
 		
 		if not self.HasTable('objtypes'):
 			self._CreateTables()
 			
 	# ----------------------------------------------------------------------------------------
-	def FindType(self, obj):
-		table	=	obj._Table()
+	@staticmethod
+	def Current():
+		conn	=	getattr(DB.LOCAL, 'conn', None)
 		
-		if not self.objtypes:
-			for r in self.cursor.execute("SELECT * FROM objtypes"):
-				self.objtypes[r['id']]	=	(r['classname'], r['tablename'])
+		if conn:
+			return conn
 		
-		for k, v in self.objtypes.items():
-			if v[1] == table:
-				return k
+		if DB.DEFAULTPOOL:
+			return DB.DEFAULTPOOL.Get()
 		
-		try:
+		return None
+		
+	# ----------------------------------------------------------------------------------------
+	def Close(self):
+		if getattr(DB.LOCAL, 'conn', None) is self:
+			DB.LOCAL.conn	=	None
+		
+		self.dbconn.close()
+			
+	# ----------------------------------------------------------------------------------------
+	# Returns the objtypes id of obj's table from the in-memory registry,
+	# which is read once and only touches the database for new types.
+	def FindType(self, obj):
+		table		=	obj._Table()
+		typeid	=	self.typeids.get(table)
+		
+		if typeid != None:
+			return typeid
+		
+		with self.typeslock:
+			if not self.typesloaded:
+				self._LoadTypes()
+				
+				typeid	=	self.typeids.get(table)
+				
+				if typeid != None:
+					return typeid
+			
+			# Another process may have registered the type since we loaded
 			r	=	self.Query("SELECT id FROM objtypes WHERE tablename = ?", [table])
 			
 			if r:
-				self.objtypes[r['id']]	=	(obj.__class__.__name__, table)
-				return r['id']
-					
-			self.Query(
-				"INSERT INTO objtypes(classname, tablename) VALUES(?, ?)",
-				[obj.__class__.__name__, table]
-			)
+				typeid	=	r[0]['id']
+			else:
+				self.Query(
+					"INSERT INTO objtypes(classname, tablename) VALUES(?, ?)",
+					[obj.__class__.__name__, table]
+				)
+				typeid	=	self.cursor.lastrowid
 			
-			typeid	=	self.cursor.lastrowid
+			# objtypes is filled first so that any id found in typeids can
+			# always be resolved by readers on other threads
 			self.objtypes[typeid]	=	(obj.__class__.__name__, table)
-		except Exception as e:
-			self.cursor.rollback()
-			
+			self.typeids[table]		=	typeid
+		
 		return typeid
 		
+	# ----------------------------------------------------------------------------------------
+	def _LoadTypes(self):
+		objtypes	=	{}
+		typeids		=	{}
+		
+		for r in self.Query("SELECT id, classname, tablename FROM objtypes"):
+			objtypes[r['id']]				=	(r['classname'], r['tablename'])
+			typeids[r['tablename']]	=	r['id']
+		
+		self.objtypes			=	objtypes
+		self.typeids			=	typeids
+		self.typesloaded	=	True
+		
+	# ----------------------------------------------------------------------------------------
+	def SetPragmas(self, pragmas):
+		for k, v in pragmas.items():
+			self.dbconn.execute("PRAGMA {} = {}".format(k, v)).fetchall()
+		
 	# ----------------------------------------------------------------------------------------
 	def Debug(self, state	=	True):
 		self.debug	=	state
 		
 	# ----------------------------------------------------------------------------------------
-	def Query(self, query, params	=	None):		
+	# Keeps up to size rows loaded by ModelBase.Load() in memory. A size
+	# of 0 disables the cache. Rows changed through ModelBase are 
+	# invalidated automatically, but raw queries must call Uncache().
+	def SetCacheSize(self, size):
+		if size:
+			self.rowcache	=	RowCache(size)
+		else:
+			self.rowcache	=	None
+		
+	# ----------------------------------------------------------------------------------------
+	def Uncache(self, table, ids = None):
+		if not self.rowcache:
+			return
+		
+		if ids == None:
+			self.rowcache.Clear()
+			return
+			
+		for id in ids:
+			self.rowcache.Remove((table, id))
+		
+	# ----------------------------------------------------------------------------------------
+	@staticmethod
+	def _Params(params):
 		if params == None:
-			params	=	[]
+			return []
 			
 		if not isinstance(params, list) and not isinstance(params, tuple):
-			params	=	(params,)
+			return (params,)
+		
+		return params
+		
+	# ----------------------------------------------------------------------------------------
+	def Query(self, query, params	=	None):		
+		params	=	DB._Params(params)
 			
 		if self.debug:
 			Print('DB: Executing query: {} with params {}', query, params)
@@ -118,6 +312,113 @@ class DB(object):
 		
 		return results
 		
+	# ----------------------------------------------------------------------------------------
+	# Yields rows one at a time while only holding chunksize of them in
+	# memory. Uses its own cursor so that other queries can be run on
+	# this connection while iterating.
+	def IterQuery(self, query, params	=	None, chunksize	=	None):
+		params	=	DB._Params(params)
+		
+		if self.debug:
+			Print('DB: Iterating query: {} with params {}', query, params)
+		
+		cursor	=	self.dbconn.cursor()
+		cursor.arraysize	=	chunksize if chunksize else DB.FETCHSIZE
+		
+		try:
+			cursor.execute(query, params)
+			
+			while True:
+				results	=	cursor.fetchmany()
+				
+				if not results:
+					break
+				
+				for r in results:
+					yield r
+		finally:
+			cursor.close()
+		
+	# ----------------------------------------------------------------------------------------
+	def ExecuteMany(self, query, rows):
+		if self.debug:
+			Print('DB: Executing query: {} with {} rows', query, len(rows))
+		
+		with self.Transaction():
+			self.cursor.executemany(query, rows)
+		
+		return self.cursor.rowcount
+		
+	# ----------------------------------------------------------------------------------------
+	# Inserts rows of field values (dicts or model objects) for model
+	# in one transaction and returns the ids assigned to them.
+	def BulkInsert(self, model, rows):
+		rows		=	list(rows)
+		values	=	[r._FieldValues() if isinstance(r, ModelBase) else model._FieldValues(r) for r in rows]
+		
+		if not values:
+			return []
+		
+		query	=	model._SQL('insert')
+		
+		with self.Transaction():
+			for r in rows:
+				if isinstance(r, ModelBase):
+					self._Remember(r)
+			
+			try:
+				self.ExecuteMany(query, values)
+			except Exception as e:
+				if 'no such table' in str(e):
+					model.CreateTable()
+					self.ExecuteMany(query, values)
+				else:
+					raise e
+			
+			# executemany() does not set lastrowid, but the rows of a single
+			# statement inside our own write transaction get consecutive ids.
+			lastid	=	self.cursor.execute("SELECT last_insert_rowid()").fetchone()[0]
+		
+		for r, v in zip(rows, values):
+			if isinstance(r, ModelBase):
+				r._Saved(model._FieldNames(), v)
+		
+		return list(range(lastid - len(values) + 1, lastid + 1))
+		
+	# ----------------------------------------------------------------------------------------
+	# Updates rows (dicts or model objects which include their id) of 
+	# model in one transaction. Only fieldnames are written if given.
+	def BulkUpdate(self, model, rows, fieldnames = None):
+		if not fieldnames:
+			fieldnames	=	model._FieldNames()
+		
+		fieldnames	=	tuple(fieldnames)
+		rows				=	list(rows)
+		values			=	[]
+		
+		for r in rows:
+			if isinstance(r, ModelBase):
+				values.append(r._FieldValues(fieldnames = fieldnames) + [r.id])
+			else:
+				values.append(model._FieldValues(r, fieldnames) + [r['id']])
+		
+		if not values:
+			return 0
+		
+		self.Uncache(model._Table(), [v[-1] for v in values])
+		
+		for r in rows:
+			if isinstance(r, ModelBase):
+				self._Remember(r)
+		
+		rowcount	=	self.ExecuteMany(model._SQL('update', fieldnames), values)
+		
+		for r, v in zip(rows, values):
+			if isinstance(r, ModelBase):
+				r._Saved(fieldnames, v[:-1])
+		
+		return rowcount
+		
 	# ----------------------------------------------------------------------------------------
 	def HasTable(self, table):
 		try:
@@ -129,14 +430,137 @@ class DB(object):
 	# ----------------------------------------------------------------------------------------
 	def Begin(self):
 		self.dbconn.execute("BEGIN TRANSACTION")
+		self.begun	=	True
 		
 	# ----------------------------------------------------------------------------------------
 	def Commit(self):
+		if self.writequeue or self.configwrites:
+			self.Flush()
+		
 		self.dbconn.commit()
+		self.begun	=	False
+		self.undo		=	[]
+		
+	# ----------------------------------------------------------------------------------------
+	# Makes ModelBase.Save() queue objects instead of writing them. The
+	# queue is written in one transaction once it holds maxsize objects 
+	# or its oldest entry is maxage seconds old. New objects only get 
+	# their ids when the queue is flushed. A maxsize of 0 turns it off.
+	def WriteBehind(self, maxsize = 500, maxage = 3.0):
+		if maxsize:
+			self.writebehind	=	(maxsize, maxage)
+		else:
+			self.Flush()
+			self.writebehind	=	None
+		
+	# ----------------------------------------------------------------------------------------
+	def Queue(self, obj):
+		if not self.writequeue:
+			self.queuetime	=	time.time()
+		
+		self.writequeue[id(obj)]	=	obj
+		
+		maxsize, maxage	=	self.writebehind
+		
+		if len(self.writequeue) >= maxsize or time.time() - self.queuetime >= maxage:
+			self.Flush()
+		
+	# ----------------------------------------------------------------------------------------
+	# Writes all queued objects and commits, so that everything saved
+	# before the call is on disk when it returns. Inside a transaction
+	# opened with Begin() or Transaction(), the writes are left for its 
+	# owner to commit.
+	def Flush(self):
+		objs	=	list(self.writequeue.values())
+		
+		try:
+			with self.Transaction():
+				if objs:
+					objs[0].SaveMany(objs)
+				
+				if self.configwrites:
+					self.ExecuteMany(DB.CONFIGUPSERT, list(self.configwrites.items()))
+		except Exception as e:
+			# Objects which can never be written are taken off the queue
+			# so that they do not break every later flush
+			for o in objs:
+				try:
+					o._Validate()
+				except Exception:
+					del self.writequeue[id(o)]
+			
+			raise e
+		
+		self.writequeue.clear()
+		self.configwrites	=	{}
+		
+		if not self.begun:
+			self.dbconn.commit()
+			self.undo	=	[]
+		
+	# ----------------------------------------------------------------------------------------
+	# Runs the enclosed block in a transaction, or joins the one opened 
+	# by Begin() so that batches can be nested inside it. sqlite3 also 
+	# opens transactions by itself for plain writes. Inside one of those
+	# the block gets a savepoint, so that a failed batch still undoes 
+	# its own writes but leaves the earlier ones alone.
+	@contextlib.contextmanager
+	def Transaction(self):
+		if self.begun:
+			yield self
+			return
+		
+		if self.dbconn.in_transaction:
+			self.savepoints	+=	1
+			savepoint				=	'batch{}'.format(self.savepoints)
+			undo						=	len(self.undo)
+			
+			self.dbconn.execute('SAVEPOINT ' + savepoint)
+			
+			try:
+				yield self
+			except:
+				self.dbconn.execute('ROLLBACK TO ' + savepoint)
+				self.dbconn.execute('RELEASE ' + savepoint)
+				self._Undo(undo)
+				raise
+			finally:
+				self.savepoints	-=	1
+			
+			self.dbconn.execute('RELEASE ' + savepoint)
+			return
+		
+		self.Begin()
+		
+		try:
+			yield self
+		except:
+			self.Rollback()
+			raise
+		
+		self.dbconn.commit()
+		self.begun	=	False
+		self.undo		=	[]
 		
 	# ----------------------------------------------------------------------------------------
 	def Rollback(self):
 		self.dbconn.rollback()
+		self.begun	=	False
+		self._Undo()
+		
+	# ----------------------------------------------------------------------------------------
+	# Called before obj is written so that Rollback() can give it back 
+	# the id and saved values it had.
+	def _Remember(self, obj):
+		self.undo.append((obj, obj.id, dict(obj._original)))
+		
+	# ----------------------------------------------------------------------------------------
+	def _Undo(self, start = 0):
+		for obj, id, original in reversed(self.undo[start:]):
+			obj.id				=	id
+			obj._original	=	original
+		
+		del self.undo[start:]
 		
 	# ----------------------------------------------------------------------------------------
 	@staticmethod
@@ -180,54 +604,103 @@ class DB(object):
 				);
 				"""
 			)
+			
+		for k, v in DB.INDEXES.items():
+			self.CreateIndex(k, *v)
+		
+	# ------------------------------------------------------------------
+	def CreateIndex(self, name, table, columns, flags = ''):
+		self.Query("CREATE {flags} INDEX IF NOT EXISTS {name} ON {table}({columns})".format(**locals()))
+		
+	# ------------------------------------------------------------------
+	# Adds any indexes declared since the database was created, both on
+	# the internal tables and the tables of the given models.
+	def EnsureIndexes(self, *models):
+		self._EnsureConfigIndex()
+		
+		with self.Transaction():
+			for k, v in DB.INDEXES.items():
+				self.CreateIndex(k, *v)
+			
+			for model in models:
+				if self.HasTable(model._Table()):
+					model.CreateIndexes()
+		
+	# ------------------------------------------------------------------
+	# Databases created before dbconfig_key existed may hold the same key
+	# more than once, so only the latest value is kept before indexing.
+	def _EnsureConfigIndex(self):
+		if self.Query("SELECT name FROM sqlite_master WHERE type = 'index' AND name = 'dbconfig_key'"):
+			return
+		
+		with self.Transaction():
+			self.Query("DELETE FROM dbconfig WHERE id NOT IN (SELECT MAX(id) FROM dbconfig GROUP BY key)")
+			self.CreateIndex('dbconfig_key', *DB.INDEXES['dbconfig_key'])
+		
+	# ------------------------------------------------------------------
+	def _LoadConfig(self):
+		self._EnsureConfigIndex()
+		
+		self.config	=	{}
+		
+		for r in self.Query("SELECT key, value FROM dbconfig"):
+			self.config[r['key']]	=	r['value']
+		
+	# ------------------------------------------------------------------
+	# Holds dbconfig writes in memory until the next Commit() or Flush().
+	def DeferConfigWrites(self, state = True):
+		self.deferconfig	=	state
+		
+		if not state and self.configwrites:
+			self.Flush()
 		
 	# ------------------------------------------------------------------
 	def __getitem__(self, key, value = None):
-		r	=	self.Query("SELECT value FROM dbconfig WHERE key = ?", [key])
+		if self.config == None:
+			self._LoadConfig()
 		
 		if value == None:			
-			if r:
-				return r[0]['value']
+			return self.config.get(key)
 				
 		return None
 		
 	# ------------------------------------------------------------------
 	def __setitem__(self, key, value):
-		r	=	self.Query("SELECT value FROM dbconfig WHERE key = ?", [key])
+		if self.config == None:
+			self._LoadConfig()
 		
-		if r:
-			self.Query("UPDATE dbconfig SET value = ? WHERE key = ?", [value, key])
+		if key in self.config and self.config[key] == value:
+			return
+		
+		self.config[key]	=	value
+		
+		if self.deferconfig:
+			self.configwrites[key]	=	value
 		else:
-			self.Query("INSERT INTO dbconfig(key, value) VALUES(?, ?)", [key, value])
+			self.Query(DB.CONFIGUPSERT, [key, value])
 		
 	# ------------------------------------------------------------------
-	# Delete orphaned links
+	# Delete orphaned links with one anti-join per object type. Returns
+	# the number of links removed for each table.
 	def TidyLinks(self):
-		numtidied	=	0
+		numtidied	=	{}
 		
 		try:
-			with self.dbconn as conn:
-				cur	=	conn.cursor()
-				for r in cur.execute("SELECT type1, id1, type2, id2 FROM links"):
-					r	=	cur.execute("SELECT id FROM {self.objtypes[r['type1']][1]} WHERE id = {r['id1']}".format(**locals()))
+			with self.Transaction():
+				for r in self.Query("SELECT id, tablename FROM objtypes"):
+					typeid	=	r['id']
+					table		=	r['tablename']
 					
-					if not r:
-						numtidied	+=	1
-						conn.execute("""DELETE FROM links 
-							WHERE type1 = {r['type1']} 
-								AND id1 = {r['id1']}
-								AND type2 = {r['type2']} 
-								AND id2 = {r['id2']}""".format(**locals()))
-
-					r	=	cur.execute("SELECT id FROM {self.objtypes[r['type2']][1]} WHERE id = {r['id2']}")
+					if self.HasTable(table):
+						self.Query("""DELETE FROM links 
+							WHERE (type1 = ? AND NOT EXISTS (SELECT 1 FROM {table} WHERE {table}.id = links.id1))
+								OR (type2 = ? AND NOT EXISTS (SELECT 1 FROM {table} WHERE {table}.id = links.id2))""".format(**locals()),
+							[typeid, typeid]
+						)
+					else:
+						self.Query("DELETE FROM links WHERE type1 = ? OR type2 = ?", [typeid, typeid])
 					
-					if not r:
-						numtidied	+=	1
-						conn.execute("""DELETE FROM links 
-							WHERE type1 = {r['type1']} 
-								AND id1 = {r['id1']}
-								AND type2 = {r['type2']} 
-								AND id2 = {r['id2']}""".format(**locals()))
+					numtidied[table]	=	self.cursor.rowcount
 		except Exception as e:
 			logging.warning('Unable to tidy links: {}'.format(e))
 			return -1
@@ -235,25 +708,52 @@ class DB(object):
 		return numtidied
 		
 	# ------------------------------------------------------------------
+	# Looks up translations in memory first. Texts which were not found
+	# are remembered as well, and languages loaded by 
+	# PreloadTranslations() never query the database again.
 	def Translate(self, textid, vardict	=	None):
-		if vardict == None:
-			vardict	=	{}
-			
-		t	=	self.Query(
-			"SELECT text FROM translations WHERE textid = ? AND language = ?", 
-			(textid, self.language)
-		)
+		key	=	(textid, self.language)
+		t		=	self.translations.get(key)
 		
-		if not t:
-			return ''
+		if t == None:
+			if self.language in self.preloaded:
+				t	=	''
+			else:
+				r	=	self.Query(
+					"SELECT text FROM translations WHERE textid = ? AND language = ?", 
+					(textid, self.language)
+				)
+				
+				t	=	r[0]['text'] if r else ''
+				self.translations[key]	=	t
 		
 		if vardict:
-			t	=	t.format(vardict)		
+			t	=	t.format(**vardict)
 			
 		return t
 		
 	# ------------------------------------------------------------------
-	def SetTranslation(language, text, id):
+	def PreloadTranslations(self, language = None):
+		if not language:
+			language	=	self.language
+		
+		for r in self.IterQuery("SELECT textid, text FROM translations WHERE language = ?", [language]):
+			self.translations[(r['textid'], language)]	=	r['text']
+		
+		self.preloaded.add(language)
+		
+	# ------------------------------------------------------------------
+	# Drops cached translations after they were changed elsewhere.
+	def ClearTranslations(self, language = None):
+		if language:
+			self.translations	=	{k: v for k, v in self.translations.items() if k[1] != language}
+			self.preloaded.discard(language)
+		else:
+			self.translations	=	{}
+			self.preloaded		=	set()
+		
+	# ------------------------------------------------------------------
+	def SetTranslation(self, language, text, id = None):
 		maxid	=	0
 		
 		if id:
@@ -267,9 +767,11 @@ class DB(object):
 					(text, id, language)
 				)
 			else:
-				self.Query("INSERT INTO translations VALUES(?, ?, ?)", 
+				self.Query("INSERT INTO translations(textid, language, text) VALUES(?, ?, ?)", 
 					(id, language, text)
 				)
+			
+			self.translations[(id, language)]	=	text
 			return id
 		else:
 			r	=	self.Query(
@@ -282,8 +784,9 @@ class DB(object):
 			
 			r	=	self.Query('SELECT MAX(textid) FROM translations')
 			
-			maxid	=	int(r[0]['MAX(textid)']) + 1 if r else 1
-			self.Query("INSERT INTO translations VALUES(?, ?, ?)", (maxid, language, text))
+			maxid	=	(r[0][0] or 0) + 1
+			self.Query("INSERT INTO translations(textid, language, text) VALUES(?, ?, ?)", (maxid, language, text))
+			self.translations[(maxid, language)]	=	text
 		
 		return maxid
 		
@@ -307,6 +810,212 @@ class DB(object):
 				ALTER TABLE temptable RENAME TO {model->TABLE};""".format(**locals())
 			)
 
+# *********************************************************************
+# Hands out connections to one database for multithreaded use. Get() 
+# returns a connection owned by the calling thread, while Checkout() 
+# and Return(), or the Connection() context manager, lend one of at 
+# most size shared connections for a block of work.
+class DBPool(object):
+	
+	# -------------------------------------------------------------------
+	def __init__(self, dbname, size = 4, **kwargs):
+		self.dbname			=	dbname
+		self.size				=	size
+		self.kwargs			=	kwargs
+		self.local			=	threading.local()
+		self.lock				=	threading.Lock()
+		self.available	=	threading.BoundedSemaphore(size)
+		self.idle				=	[]
+		self.opened			=	[]
+		
+		if not DB.DEFAULTPOOL:
+			DB.DEFAULTPOOL	=	self
+		
+	# -------------------------------------------------------------------
+	def _Open(self, checksamethread):
+		db	=	DB(
+			dbname					=	self.dbname, 
+			checksamethread	=	checksamethread, 
+			register				=	False, 
+			**self.kwargs
+		)
+		
+		with self.lock:
+			self.opened.append(db)
+		
+		return db
+		
+	# -------------------------------------------------------------------
+	def Get(self):
+		db	=	getattr(self.local, 'conn', None)
+		
+		if not db:
+			db	=	self._Open(True)
+			self.local.conn	=	db
+		
+		return db
+		
+	# -------------------------------------------------------------------
+	def Checkout(self, timeout = None):
+		if not self.available.acquire(timeout = timeout if timeout != None else -1):
+			raise Exception('No free connection to {} after {} seconds'.format(self.dbname, timeout))
+		
+		with self.lock:
+			db	=	self.idle.pop() if self.idle else None
+		
+		if not db:
+			try:
+				db	=	self._Open(False)
+			except:
+				self.available.release()
+				raise
+		
+		return db
+		
+	# -------------------------------------------------------------------
+	def Return(self, db):
+		if db.dbconn.in_transaction:
+			db.Rollback()
+		
+		with self.lock:
+			self.idle.append(db)
+		
+		self.available.release()
+		
+	# -------------------------------------------------------------------
+	# Checks out a connection and makes it the current one for this 
+	# thread, so that ModelBase objects use it inside the block.
+	@contextlib.contextmanager
+	def Connection(self, timeout = None):
+		db				=	self.Checkout(timeout)
+		previous	=	getattr(DB.LOCAL, 'conn', None)
+		
+		DB.LOCAL.conn	=	db
+		
+		try:
+			yield db
+		finally:
+			DB.LOCAL.conn	=	previous
+			self.Return(db)
+		
+	# -------------------------------------------------------------------
+	# Connections owned by other threads can only be closed by them, so
+	# those are left for the garbage collector.
+	def Close(self):
+		with self.lock:
+			opened			=	self.opened
+			self.opened	=	[]
+			self.idle		=	[]
+		
+		for db in opened:
+			try:
+				db.Close()
+			except sqlite3.ProgrammingError:
+				pass
+		
+		if DB.DEFAULTPOOL is self:
+			DB.DEFAULTPOOL	=	None
+
+# *********************************************************************
+# Runs the database on a thread of its own for asyncio code, so that an 
+# event loop never waits on disk. Every call is run in order on that 
+# thread. Save() calls made while the loop is busy are queued and then 
+# written together in one transaction. Objects returned by AsyncDB are 
+# bound to its thread and should only be saved or loaded through it.
+class AsyncDB(object):
+	
+	# -------------------------------------------------------------------
+	def __init__(self, dbname, **kwargs):
+		self.dbname			=	dbname
+		self.kwargs			=	kwargs
+		self.executor		=	concurrent.futures.ThreadPoolExecutor(max_workers = 1)
+		self.db					=	None
+		self.pending		=	[]
+		self.flushtask	=	None
+		
+	# -------------------------------------------------------------------
+	def _Conn(self):
+		if not self.db:
+			self.db	=	DB(dbname = self.dbname, register = False, **self.kwargs)
+		
+		return self.db
+		
+	# -------------------------------------------------------------------
+	async def _Run(self, func, *args):
+		loop	=	asyncio.get_event_loop()
+		return await loop.run_in_executor(self.executor, functools.partial(func, *args))
+		
+	# -------------------------------------------------------------------
+	async def Query(self, query, params = None):
+		return await self._Run(lambda: self._Conn().Query(query, params))
+		
+	# -------------------------------------------------------------------
+	async def Find(self, model, cond = '', params = None, fields = '*'):
+		return await self._Run(lambda: model.__class__(db = self._Conn()).Find(cond, params, fields))
+		
+	# -------------------------------------------------------------------
+	async def Load(self, model, id, fields = '*'):
+		def load():
+			model._db	=	self._Conn()
+			return model.Load(id, fields)
+		
+		return await self._Run(load)
+		
+	# -------------------------------------------------------------------
+	# Returns the id of obj once its batch has been committed.
+	async def Save(self, obj):
+		loop		=	asyncio.get_event_loop()
+		future	=	loop.create_future()
+		
+		self.pending.append((obj, future))
+		
+		if not self.flushtask:
+			self.flushtask	=	loop.create_task(self.Flush())
+		
+		return await future
+		
+	# -------------------------------------------------------------------
+	# Writes every queued Save() in one transaction. Errors are passed
+	# on to the Save() calls of the batch.
+	async def Flush(self):
+		self.flushtask	=	None
+		pending					=	self.pending
+		self.pending		=	[]
+		
+		if not pending:
+			return
+		
+		try:
+			ids	=	await self._Run(self._SaveMany, [p[0] for p in pending])
+		except Exception as e:
+			for obj, future in pending:
+				if not future.done():
+					future.set_exception(e)
+			return
+		
+		for (obj, future), id in zip(pending, ids):
+			if not future.done():
+				future.set_result(id)
+		
+	# -------------------------------------------------------------------
+	def _SaveMany(self, objs):
+		conn	=	self._Conn()
+		
+		for o in objs:
+			o._db	=	conn
+		
+		return objs[0].SaveMany(objs)
+		
+	# -------------------------------------------------------------------
+	async def Close(self):
+		await self.Flush()
+		
+		if self.db:
+			await self._Run(self.db.Close)
+			self.db	=	None
+		
+		self.executor.shutdown()
+
 # *********************************************************************
 class BaseValidator(object):
 	pass
@@ -371,6 +1080,13 @@ class RangeValidator(BaseValidator):
 # *********************************************************************
 class ModelBase(object):
 	
+	# SQL strings shared by every instance of a model class, keyed by
+	# (class, statement, fieldnames)
+	_STATEMENTS	=	{}
+	
+	# namedtuple classes made by FindRecords(), keyed by (class, fields)
+	_RECORDTYPES	=	{}
+	
 	# -------------------------------------------------------------------
 	def __init__(self, db	=	None):
 		if db:
@@ -380,12 +1096,54 @@ class ModelBase(object):
 	
 	# -------------------------------------------------------------------
 	def _DB(self):
-		return self._db if hasattr(self, '_db') else DB.DEFAULTCONN
+		return self._db if hasattr(self, '_db') else DB.Current()
 		
 	# -------------------------------------------------------------------
 	def _Table(self):
 		return self._table if hasattr(self, '_TABLE') else self.__class__.__name__.lower()
 		
+	# -------------------------------------------------------------------
+	def _FieldNames(self):
+		return self._SQL('fieldnames')
+		
+	# -------------------------------------------------------------------
+	# Builds each statement once per model class so that the hot paths
+	# only do a dict lookup. sqlite3 then reuses the compiled statement
+	# from the per-connection cache since the SQL text never changes.
+	def _SQL(self, statement, fieldnames = None):
+		key	=	(self.__class__, statement, fieldnames)
+		sql	=	ModelBase._STATEMENTS.get(key)
+		
+		if sql != None:
+			return sql
+		
+		table	=	self._Table()
+		keys	=	list(fieldnames if fieldnames else self._fields.keys())
+		
+		if statement == 'fieldnames':
+			sql	=	tuple(keys)
+		elif statement == 'insert':
+			sql	=	"INSERT INTO {}({}) VALUES({})".format(
+				table, 
+				', '.join(keys), 
+				', '.join(['?' for k in keys])
+			)
+		elif statement == 'update':
+			sql	=	"UPDATE {} SET {} WHERE id = ?".format(table, ', '.join([k + ' = ?' for k in keys]))
+		elif statement == 'load':
+			sql	=	"SELECT * FROM {} WHERE id = ?".format(table)
+		elif statement == 'select':
+			sql	=	"SELECT * FROM {} ".format(table)
+		elif statement == 'count':
+			sql	=	"SELECT COUNT(*) FROM {} ".format(table)
+		elif statement == 'delete':
+			sql	=	"DELETE FROM {} WHERE id = ?".format(table)
+		else:
+			raise Exception('Unknown statement {}'.format(statement))
+		
+		ModelBase._STATEMENTS[key]	=	sql
+		return sql
+		
 	# -------------------------------------------------------------------
 	def __hash__(self):
 		return self.id if self.id else 0
@@ -420,12 +1178,48 @@ class ModelBase(object):
 		
 		conn.Query("CREATE TABLE {table}({fields})".format(**locals()))
 		
-		if hasattr(self, '_indexes'):
-			for k, v in self._indexes.items():
-				conn.Query("CREATE INDEX {k} ON {table}({v})".format(**locals()))
+		self.CreateIndexes()
+		
+		return self
+		
+	# -------------------------------------------------------------------
+	# Adds columns for fields which were added to the model after its 
+	# table was created. New NOT NULL fields need a DEFAULT for this.
+	def AddMissingColumns(self):
+		conn	=	self._DB()
+		table	=	self._Table()
+		
+		columns	=	set(r['name'] for r in conn.Query("PRAGMA table_info({})".format(table)))
+		
+		if not columns:
+			return self.CreateTable()
+		
+		for k, v in self._fields.items():
+			if k in columns:
+				continue
+			
+			fieldtype	=	'TEXT' if v[0] == 'JSON' else v[0]
+			
+			conn.Query("ALTER TABLE {} ADD COLUMN {} {} {}".format(table, k, fieldtype, v[1]))
 		
 		return self
 		
+	# -------------------------------------------------------------------
+	# _indexes maps index names to their columns, or to a tuple of
+	# (columns, 'UNIQUE'). Extra trailing columns make covering indexes.
+	def CreateIndexes(self):
+		if not hasattr(self, '_indexes'):
+			return
+		
+		conn	=	self._DB()
+		table	=	self._Table()
+		
+		for k, v in self._indexes.items():
+			if isinstance(v, tuple):
+				conn.CreateIndex(k, table, *v)
+			else:
+				conn.CreateIndex(k, table, v)
+		
 	# ------------------------------------------------------------------
 	def _ImportFields(self, fields):
 		for k in self._fields.keys():
@@ -434,7 +1228,9 @@ class ModelBase(object):
 				
 	# ------------------------------------------------------------------
 	def _InitFields(self):
-		self.id	=	None
+		self.id					=	None
+		self._rawjson		=	{}
+		self._original	=	{}
 		
 		for k, v in self._fields.items():
 			if 'NOT NULL' in v[1] and (v[0] == 'INT' or v[0] == 'FLOAT'):
@@ -446,7 +1242,9 @@ class ModelBase(object):
 	
 	# ------------------------------------------------------------------
 	def _ConvertFields(self, fields):
-		self.id	=	fields['id']
+		self.id					=	fields['id']
+		self._rawjson		=	{}
+		self._original	=	{}
 		
 		if not self.id:
 			raise Exception('No {} with ID {} was found.'.format(
@@ -459,25 +1257,86 @@ class ModelBase(object):
 				setattr(self, k, None)
 				continue
 			
+			self._original[k]	=	fields[k]
+			
 			if fields[k] != None:
 				if v[0] == 'INT':
-						setattr(self, k, int(fields[k]))
+					self._original[k]	=	int(fields[k])
+					setattr(self, k, self._original[k])
 				elif v[0] == 'FLOAT':
-					setattr(self, k, float(fields[k]))
+					self._original[k]	=	float(fields[k])
+					setattr(self, k, self._original[k])
 				elif v[0] == 'JSON':
-					setattr(self, k, json.loads(fields[k]))
+					# Decoded by __getattr__() when it is first read
+					self.__dict__.pop(k, None)
+					self._rawjson[k]	=	fields[k]
 				else:
 					setattr(self, k, fields[k])
 			else:
 				setattr(self, k, fields[k])
 				
+	# ------------------------------------------------------------------
+	# Returns the fields whose values differ from what was last loaded
+	# or saved. Fields which were not loaded count once they are set.
+	def _DirtyFields(self):
+		dirty	=	[]
+		
+		for k, v in self._fields.items():
+			if k in self._rawjson and k not in self.__dict__:
+				continue
+			
+			value	=	getattr(self, k)
+			
+			if k not in self._original:
+				if value != None:
+					dirty.append(k)
+				continue
+			
+			if v[0] == 'JSON' and not (value == None and self._original[k] == None):
+				value	=	json.dumps(value, skipkeys = True)
+			
+			if value != self._original[k]:
+				dirty.append(k)
+		
+		return tuple(dirty)
+		
+	# ------------------------------------------------------------------
+	def _Saved(self, fieldnames, values):
+		self._original.update(zip(fieldnames, values))
+		
+	# ------------------------------------------------------------------
+	# Raises the validator's exception if Save() could not write this 
+	# object.
+	def _Validate(self):
+		if not self.id:
+			self._FieldValues()
+			return
+		
+		fieldnames	=	self._DirtyFields()
+		
+		if fieldnames:
+			self._FieldValues(fieldnames = fieldnames)
+		
+	# ------------------------------------------------------------------
+	# Only called for attributes which are not set, which is the case
+	# for JSON fields that have been loaded but not read yet.
+	def __getattr__(self, name):
+		rawjson	=	self.__dict__.get('_rawjson')
+		
+		if rawjson and name in rawjson:
+			value	=	json.loads(rawjson.pop(name))
+			setattr(self, name, value)
+			return value
+		
+		raise AttributeError(name)
+		
 	# ------------------------------------------------------------------
 	def Count(self, cond = '', params = None):
 		if params == None:
 			params	=	[]
 			
 		try:
-			r	=	self._DB().Query("SELECT COUNT(*) FROM {} {}".format(self._Table(), cond), params)
+			r	=	self._DB().Query(self._SQL('count') + cond, params)
 			
 			if r:
 				return r[0]['COUNT(*)']
@@ -495,12 +1354,28 @@ class ModelBase(object):
 			raise Exception('Cannot load {} with no ID'.format(self.__class__.__name__))
 			
 		conn	=	self._DB()
-		table	=	self._Table()
+		cache	=	conn.rowcache if fields == '*' else None
+		
+		if cache:
+			key	=	(self._Table(), int(id))
+			r		=	cache.Get(key)
+			
+			if r != None:
+				self._ConvertFields(r)
+				return self
+		
+		if fields == '*':
+			query	=	self._SQL('load')
+		else:
+			query	=	"SELECT {} FROM {} WHERE id = ?".format(fields, self._Table())
 		
-		r	=	conn.Query("SELECT {fields} FROM {table} WHERE id = ?".format(**locals()), [id])
+		r	=	conn.Query(query, [id])
 		
 		if r:
 			self._ConvertFields(r[0])
+			
+			if cache:
+				cache.Set(key, r[0])
 		else:
 			raise Exception('{} with ID {} was not found.'.format(self.__class__.__name__, id))
 			
@@ -508,19 +1383,12 @@ class ModelBase(object):
 	
 	# ------------------------------------------------------------------
 	def Find(self, cond = '', params = None, fields = '*'):
-		if params == None:
-			params	=	[]
-			
 		conn	=	self._DB()
-		table	=	self._Table()
 		ls	=	[]
 		
 		try:
-			for r in conn.Query("SELECT {fields} FROM {table} {cond}".format(**locals()), params):
-				o	=	self.__class__()
-				o._db	=	conn
-				o._ConvertFields(r)
-				ls.append(o)
+			for r in conn.Query(self._SelectQuery(cond, fields), params):
+				ls.append(self._FromRow(conn, r))
 		except Exception as e:
 			if 'no such table' in str(e):
 				self.CreateTable()
@@ -529,6 +1397,86 @@ class ModelBase(object):
 		
 		return ls
 	
+	# ------------------------------------------------------------------
+	# Same as Find(), but yields the objects as they are fetched instead
+	# of building a list, so memory use does not grow with the result.
+	def IterFind(self, cond = '', params = None, fields = '*', chunksize = None):
+		conn	=	self._DB()
+		
+		try:
+			for r in conn.IterQuery(self._SelectQuery(cond, fields), params, chunksize):
+				yield self._FromRow(conn, r)
+		except Exception as e:
+			if 'no such table' in str(e):
+				self.CreateTable()
+			else:
+				raise e
+	
+	# ------------------------------------------------------------------
+	# Returns lightweight namedtuples holding only fields, straight from
+	# the rows, without creating model objects or decoding JSON.
+	def FindRecords(self, fields, cond = '', params = None):
+		fields, record	=	self._RecordType(fields)
+		ls							=	[]
+		
+		try:
+			for r in self._DB().Query(self._SelectQuery(cond, ', '.join(fields)), params):
+				ls.append(record._make(r))
+		except Exception as e:
+			if 'no such table' in str(e):
+				self.CreateTable()
+			else:
+				raise e
+		
+		return ls
+	
+	# ------------------------------------------------------------------
+	def IterFindRecords(self, fields, cond = '', params = None, chunksize = None):
+		fields, record	=	self._RecordType(fields)
+		
+		try:
+			for r in self._DB().IterQuery(self._SelectQuery(cond, ', '.join(fields)), params, chunksize):
+				yield record._make(r)
+		except Exception as e:
+			if 'no such table' in str(e):
+				self.CreateTable()
+			else:
+				raise e
+	
+	# ------------------------------------------------------------------
+	def _RecordType(self, fields):
+		if isinstance(fields, str):
+			fields	=	[f.strip() for f in fields.split(',')]
+		
+		key			=	(self.__class__, tuple(fields))
+		record	=	ModelBase._RECORDTYPES.get(key)
+		
+		if not record:
+			# Columns are named by their alias if they have one. Names which
+			# are still duplicated or not identifiers become _0, _1...
+			record	=	collections.namedtuple(
+				self.__class__.__name__ + 'Record', 
+				[re.split(r'\s+as\s+', f, flags = re.I)[-1].split('.')[-1] for f in fields],
+				rename = True
+			)
+			ModelBase._RECORDTYPES[key]	=	record
+		
+		return key[1], record
+	
+	# ------------------------------------------------------------------
+	def _SelectQuery(self, cond, fields):
+		if fields == '*':
+			return self._SQL('select') + cond
+		
+		return "SELECT {} FROM {} {}".format(fields, self._Table(), cond)
+	
+	# ------------------------------------------------------------------
+	def _FromRow(self, conn, r):
+		o	=	self.__class__()
+		o._db	=	conn
+		o._ConvertFields(r)
+		return o
+	
 	# ------------------------------------------------------------------
 	def New(self, **kwargs):
 		conn	=	self._DB()
@@ -547,30 +1495,45 @@ class ModelBase(object):
 		return obj
 
 	# ------------------------------------------------------------------
-	def Save(self):
-		conn	=	self._DB()
-		table	=	self._Table()
-		
-		keys	=	self._fields.keys()	
-		fieldnames		=	', '.join(self._fields.keys())
-		placeholders	=	', '.join(['?' for i in range(0, len(keys))])
-		fields				=	[]
+	def _FieldValues(self, fields = None, fieldnames = None):
+		values	=	[]
 		
-		for k, v in self._fields.items():
-			if v[0] == 'JSON':
-				fields.append(json.dumps(getattr(self, k), True))
-			elif v[0] == 'JSON':
-				if isinstance(getattr(self, k), datetime):
-					fields.append(getattr(self, k).isoformat())
-				else:
-					fields.append(getattr(self, k))
+		for k in (fieldnames if fieldnames else self._FieldNames()):
+			v			=	self._fields[k]
+			encode	=	v[0] == 'JSON'
+			
+			if fields != None:
+				value	=	fields.get(k)
+			elif k in self._rawjson and k not in self.__dict__:
+				# Never read since it was loaded, so the text is unchanged
+				value		=	self._rawjson[k]
+				encode	=	False
 			else:
-				fields.append(getattr(self, k))
+				value	=	getattr(self, k)
+			
+			if encode:
+				value	=	json.dumps(value, skipkeys = True)
 			
-			v[2].Validate(k, fields[-1])
+			v[2].Validate(k, value)
+			values.append(value)
+		
+		return values
+
+	# ------------------------------------------------------------------
+	# Objects are only queued if the connection is in write behind mode
+	# unless queue is False.
+	def Save(self, queue = True):
+		conn		=	self._DB()
+		
+		if queue and conn.writebehind:
+			conn.Queue(self)
+			return self.id
 		
 		if not self.id:
-			query	=	"INSERT INTO {table}({fieldnames}) VALUES({placeholders})".format(**locals())
+			query		=	self._SQL('insert')
+			fields	=	self._FieldValues()
+			
+			conn._Remember(self)
 			
 			try:
 				conn.Query(query, fields)
@@ -582,21 +1545,59 @@ class ModelBase(object):
 					raise e
 				
 			self.id	=	conn.cursor.lastrowid
+			self._Saved(self._FieldNames(), fields)
 			return self.id
 		else:
-			pairs	=	[]
+			# Only changed columns are written, and nothing at all if the
+			# object is the same as when it was loaded
+			fieldnames	=	self._DirtyFields()
 			
-			for k in self._fields.keys():
-				pairs.append(k + ' = ?')
+			if not fieldnames:
+				return self.id
 			
-			pairs	=	', '.join(pairs)
+			fields	=	self._FieldValues(fieldnames = fieldnames)
 			
-			conn.Query(
-				"UPDATE {table} SET {pairs} WHERE id = {self.id}".format(**locals()), 
-				fields
-			)
+			conn.Uncache(self._Table(), [self.id])
+			conn._Remember(self)
+			conn.Query(self._SQL('update', fieldnames), fields + [self.id])
+			self._Saved(fieldnames, fields)
 			return self.id
 	
+	# ------------------------------------------------------------------
+	# Saves a list of objects grouped by table with one executemany() 
+	# per group inside a single transaction. Returns their ids.
+	def SaveMany(self, objs):
+		conn		=	self._DB()
+		groups	=	{}
+		
+		# Nothing is written unless every object can be
+		for o in objs:
+			o._Validate()
+			groups.setdefault(o._Table(), []).append(o)
+		
+		with conn.Transaction():
+			for table, ls in groups.items():
+				newobjs	=	[o for o in ls if not o.id]
+				oldobjs	=	[o for o in ls if o.id]
+				
+				if newobjs:
+					for o, id in zip(newobjs, conn.BulkInsert(newobjs[0], newobjs)):
+						o.id	=	id
+				
+				# Objects changed in the same columns share one UPDATE
+				changed	=	{}
+				
+				for o in oldobjs:
+					fieldnames	=	o._DirtyFields()
+					
+					if fieldnames:
+						changed.setdefault(fieldnames, []).append(o)
+				
+				for fieldnames, ls in changed.items():
+					conn.BulkUpdate(ls[0], ls, fieldnames)
+		
+		return [o.id for o in objs]
+	
 	# ------------------------------------------------------------------
 	def Delete(self, cond = '', params = None):
 		if not params:
@@ -606,7 +1607,8 @@ class ModelBase(object):
 		table	=	self._Table()
 		
 		if not cond:
-			conn.Query("DELETE FROM {table} WHERE id = ?".format(**locals()), [self.id])
+			conn.Uncache(table, [self.id])
+			conn.Query(self._SQL('delete'), [self.id])
 			type1	=	conn.FindType(self)
 			conn.Query("""DELETE FROM links 
 				WHERE (type1 = ? AND id1 = ?)
@@ -615,7 +1617,42 @@ class ModelBase(object):
 			)
 			self.id	=	None
 		else:
-			conn.Query("DELETE FROM {table} {cond}".format(**locals()), params)
+			# Goes through DeleteMany() so that links to the rows go too
+			ids	=	[r['id'] for r in conn.Query("SELECT id FROM {table} {cond}".format(**locals()), params)]
+			self.DeleteMany(ids)
+	
+	# ------------------------------------------------------------------
+	# Deletes the rows with the given ids and their links with a few 
+	# statements in one transaction rather than a Delete() per object. 
+	# Returns the number of rows deleted.
+	def DeleteMany(self, ids):
+		ids	=	[int(id) for id in ids]
+		
+		if not ids:
+			return 0
+		
+		conn		=	self._DB()
+		table		=	self._Table()
+		type		=	conn.FindType(self)
+		count		=	0
+		
+		conn.Uncache(table, ids)
+		
+		with conn.Transaction():
+			for i in range(0, len(ids), DB.DELETESIZE):
+				chunk	=	ids[i:i + DB.DELETESIZE]
+				marks	=	', '.join(['?'] * len(chunk))
+				
+				conn.Query("DELETE FROM {} WHERE id IN ({})".format(table, marks), chunk)
+				count	+=	conn.cursor.rowcount
+				
+				conn.Query("""DELETE FROM links 
+					WHERE (type1 = ? AND id1 IN ({marks}))
+						OR (type2 = ? AND id2 IN ({marks}))""".format(marks = marks),
+					[type] + chunk + [type] + chunk
+				)
+		
+		return count
 	
 	# ------------------------------------------------------------------
 	def Link(self, obj, type = 0, num = 0, comment = None):
@@ -660,6 +1697,9 @@ class ModelBase(object):
 		return self
 
 	# ------------------------------------------------------------------
+	# Makes ls the ordered list of objects linked to this one by type.
+	# Only links which were added, removed or renumbered are written,
+	# with one executemany() for each in a single transaction.
 	def LinkList(self, ls, type = 0, comment = None):
 		if not len(ls):
 			return
@@ -667,42 +1707,61 @@ class ModelBase(object):
 		if not self.id:
 			raise Exception('Cannot link uninitialized objects.')
 		
+		for v in ls:
+			if not v.id:
+				raise Exception('Cannot link uninitialized objects.')
+		
 		conn	=	self._DB()
 		
 		type1	=	conn.FindType(self)
 		type2	=	conn.FindType(ls[0])
 		
 		if type1 > type2:
-			conn.Query(
-				"DELETE FROM links WHERE type1 = ? AND type2 = ? AND id2 = ? AND type = ?",
-				[type2, type1, self.id, type]
-			)
+			query	=	"""SELECT id1 AS id, num, comment FROM links 
+				WHERE type1 = ? AND type2 = ? AND id2 = ? AND type = ?"""
+			key		=	lambda id: (type2, id, type1, self.id)
 		else:
-			conn.Query(
-				"DELETE FROM links WHERE type1 = ? AND type2 = ? AND id1 = ? AND type = ?",
-				[type1, type2, self.id, type]
-			)
-		
-		num	=	0
-		
-		for v in ls:
-			if not v.id:
-				raise Exception('Cannot link uninitialized objects.')
-				 
-			if type1 > type2:
-				conn.Query(
-					"""INSERT INTO links(type1, id1, type2, id2, type, num, comment) 
-					VALUES(?, ?, ?, ?, ?, ?, ?)""", 
-					[type2, v.id, type1, self.id, type, num, comment]
+			query	=	"""SELECT id2 AS id, num, comment FROM links 
+				WHERE type1 = ? AND type2 = ? AND id1 = ? AND type = ?"""
+			key		=	lambda id: (type1, self.id, type2, id)
+		
+		existing	=	{}
+		wanted		=	{}
+		
+		for r in conn.Query(query, [min(type1, type2), max(type1, type2), self.id, type]):
+			existing[r['id']]	=	(r['num'], r['comment'])
+		
+		for num, v in enumerate(ls):
+			wanted.setdefault(v.id, num)
+		
+		deletes	=	[key(id) + (type,) for id in existing if id not in wanted]
+		inserts	=	[key(id) + (type, num, comment) for id, num in wanted.items() if id not in existing]
+		updates	=	[
+			(num, comment) + key(id) + (type,) 
+			for id, num in wanted.items() 
+			if id in existing and existing[id] != (num, comment)
+		]
+		
+		with conn.Transaction():
+			if deletes:
+				conn.ExecuteMany(
+					"DELETE FROM links WHERE type1 = ? AND id1 = ? AND type2 = ? AND id2 = ? AND type = ?",
+					deletes
 				)
-			else:
-				conn.Query(
+			
+			if inserts:
+				conn.ExecuteMany(
 					"""INSERT INTO links(type1, id1, type2, id2, type, num, comment) 
 					VALUES(?, ?, ?, ?, ?, ?, ?)""", 
-					[type1, self.id, type2, v.id, type, num, comment]
+					inserts
 				)
 			
-			num	+=	1
+			if updates:
+				conn.ExecuteMany(
+					"""UPDATE links SET num = ?, comment = ? 
+					WHERE type1 = ? AND id1 = ? AND type2 = ? AND id2 = ? AND type = ?""",
+					updates
+				)
 		
 		return self
 	
@@ -747,6 +1806,8 @@ class ModelBase(object):
 		return self
 	
 	# ------------------------------------------------------------------
+	# Loads every linked object of obj's class ordered by num with one 
+	# join against its table. fields can limit the columns loaded.
 	def Linked(self, obj, type = 0, fields = '*'):
 		if not self.id:
 			raise Exception('Cannot find links to an uninitialized object.')
@@ -754,53 +1815,35 @@ class ModelBase(object):
 		conn	=	self._DB()
 		type1	=	conn.FindType(self)
 		type2	=	conn.FindType(obj)
+		table	=	obj._Table()
 		
-		objs	=	[]
+		if fields == '*':
+			columns	=	'o.*'
+		else:
+			columns	=	[f.strip() for f in fields.split(',')]
+			
+			if 'id' not in columns:
+				columns.insert(0, 'id')
+			
+			columns	=	', '.join(['o.' + f for f in columns])
+		
+		query	=	"""SELECT {columns}, links.num AS linknum FROM links 
+			JOIN {table} AS o ON o.id = links.{otherid}
+			WHERE links.type1 = ? AND links.type2 = ? AND links.{ownid} = ? AND links.type = ?"""
 		
 		if type1 > type2:
-			query	=	"""SELECT id1 AS id, num FROM links 
-				WHERE type1 = ? AND type2 = ? AND id2 = ? AND type = ?
-				ORDER BY num"""
+			sql			=	query.format(otherid = 'id1', ownid = 'id2', **locals())
 			params	=	[type2, type1, self.id, type]
 		else:
-			query	=	"""SELECT id2 AS id, num FROM links 
-				WHERE type1 = ? AND type2 = ? AND id1 = ? AND type = ?
-				ORDER BY num"""
+			sql			=	query.format(otherid = 'id2', ownid = 'id1', **locals())
 			params	=	[type1, type2, self.id, type]
-		
-		for r in conn.Query(query, params):
-			try:
-				o	=	obj.__class__(db = conn)
-				o.Load(r['id'], fields)
-			except Exception as e:
-				logging.warning(
-					"No {} with ID {} was found: {}".format(
-						obj.__class__.__name__, r['id'], e
-					)
-				)
-				continue
 			
-			if r['num']:
-				objs[r['num']]	=	o
-			else:
-				objs.append(o)
+			# Links between objects of the same type can point either way
+			if type1 == type2:
+				sql			=	sql + ' UNION ALL ' + query.format(otherid = 'id1', ownid = 'id2', **locals())
+				params	=	params + [type1, type2, self.id, type]
 		
-		if type1 == type2:
-			for r in conn.Query(
-				"""SELECT id1, num FROM links 
-				WHERE type1 = ? AND type2 = ? AND id2 = ? AND type = ?
-				ORDER BY num""",
-				[type1, type2, self.id, type]
-			):
-				o	=	obj.__class__(r['id'], fields)
-				o._db	=	self._db
-				
-			if r['num']:
-				objs[r['num']]	=	o
-			else:
-				objs.append(o)
-		
-		return objs
+		return [obj._FromRow(conn, r) for r in conn.Query(sql + ' ORDER BY linknum', params)]
 
 	# ------------------------------------------------------------------
 	def Debug(self):
@@ -827,7 +1870,7 @@ class ModelBase(object):
 	# ------------------------------------------------------------------
 	def Translate(self, attr):
 		conn	=	self._DB()
-		return conn.Translate(getattr(self, attr + id)) if self.id else ''
+		return conn.Translate(getattr(self, attr + 'id')) if self.id else ''
 		
 	# -------------------------------------------------------------------
 	def Commit(self):
@@ -848,13 +1891,17 @@ class DBList(object):
 		self.filter			=	''
 		self.params			=	[]
 		self.orderby		=	''
-		self.randompos	=	0
+		self.order			=	''
+		self.keyset			=	None
+		self.descending	=	False
 		self.pos				=	0
 		self.length			=	0
 		self.cachepos		=	0
 		self.cache			=	[]
 		self.cachesize	=	32
-		self.randomlist	=	[]
+		self.randomlist	=	array.array('q')
+		
+		self._ParseOrder()
 		
 	# -------------------------------------------------------------------
 	def __iter__(self):
@@ -885,17 +1932,110 @@ class DBList(object):
 		self.params	=	params
 		self.cache	=	[]
 		self.Count()
+		
+		if self.randomlist:
+			self.SetRandom(True)
+		
 		return self
 		
 	# -------------------------------------------------------------------
 	def OrderBy(self, order):
 		self.orderby	=	order
 		self.cache		=	[]
+		self._ParseOrder()
 		self.Count()
 		return self
 		
+	# -------------------------------------------------------------------
+	# Turns the ORDER BY columns into a keyset which lets us seek from a
+	# cached row instead of counting past every row with LIMIT offset. 
+	# The id is appended so that every row has a unique position. Falls 
+	# back to plain offsets for orderings which a keyset cannot express.
+	def _ParseOrder(self):
+		table						=	self.obj._Table()
+		self.order			=	self.orderby
+		self.keyset			=	None
+		self.descending	=	False
+		
+		if sqlite3.sqlite_version_info < (3, 15, 0):
+			return
+		
+		keyset		=	[]
+		direction	=	None
+		
+		for column in self.orderby.split(','):
+			words	=	column.split()
+			
+			if not words:
+				continue
+			
+			d	=	words[1].upper() if len(words) > 1 else 'ASC'
+			
+			if len(words) > 2 or d not in ('ASC', 'DESC') or (direction and d != direction):
+				return
+			
+			direction	=	d
+			parts			=	words[0].split('.')
+			attr			=	parts[-1]
+			
+			if (len(parts) > 1 and parts[0] != table) or (attr != 'id' and attr not in self.obj._fields):
+				return
+			
+			# NULLs never match a row value comparison, so seeking across
+			# them would skip rows
+			if attr != 'id' and 'NOT NULL' not in self.obj._fields[attr][1].upper():
+				return
+			
+			keyset.append((table + '.' + attr, attr))
+		
+		if 'id' not in [k[1] for k in keyset]:
+			keyset.append((table + '.id', 'id'))
+		
+		self.keyset			=	keyset
+		self.descending	=	direction == 'DESC'
+		self.order			=	self._KeysetOrder(not self.descending)
+		
+	# -------------------------------------------------------------------
+	def _KeysetOrder(self, ascending):
+		return ', '.join([k[0] + (' ASC' if ascending else ' DESC') for k in self.keyset])
+		
+	# -------------------------------------------------------------------
+	def _FilterWith(self, condition):
+		m	=	re.search(r'\bWHERE\b', self.filter, re.IGNORECASE)
+		
+		if not m:
+			return self.filter + ' WHERE ' + condition
+		
+		return self.filter[:m.start()] + 'WHERE (' + self.filter[m.end():] + ') AND ' + condition
+		
+	# -------------------------------------------------------------------
+	# Returns count rows after skipping skip rows from obj in the given
+	# direction, or None if obj has no usable key.
+	def _Seek(self, obj, forward, skip, count):
+		values	=	[getattr(obj, k[1]) for k in self.keyset]
+		
+		if None in values:
+			return None
+		
+		columns				=	', '.join([k[0] for k in self.keyset])
+		placeholders	=	', '.join(['?' for k in self.keyset])
+		op						=	'>' if forward != self.descending else '<'
+		
+		query	=	Printf(
+			'{} ORDER BY {} LIMIT {}, {}',
+			self._FilterWith(Printf('({}) {} ({})', columns, op, placeholders)),
+			self._KeysetOrder(op == '>'),
+			skip,
+			count
+		)
+		
+		return self.obj.Find(query, list(self.params) + values)
+		
 	# -------------------------------------------------------------------
 	def __len__(self):
+		if self.randomlist:
+			return len(self.randomlist)
+		
 		if not self.cache:
 			self.Count()
 		
@@ -903,11 +2043,6 @@ class DBList(object):
 		
 	# -------------------------------------------------------------------
 	def __getitem__(self, pos):
-		if self.randomlist:
-			self.randompos	=	self.randomlist[pos]
-			self._RefreshCache(self.randompos)
-			return self.cache[0]
-		
 		if not self.cache or pos < self.cachepos or pos > self.cachepos + len(self.cache) - 1:
 			self._RefreshCache(pos)
 		
@@ -915,44 +2050,112 @@ class DBList(object):
 		
 	# -------------------------------------------------------------------
 	def __delitem__(self, pos):
-		if self.randomlist:
-			self.randompos	=	self.randomlist[pos]
-			self._RefreshCache(self.randompos)
-			self.cache[self.randompos - self.cachepos].Delete()
-			del self.cache[self.randompos - self.cachepos]
-			self.length	-=	1
-			return self
-		
 		if not self.cache or pos < self.cachepos or pos > self.cachepos + len(self.cache) - 1:
 			self._RefreshCache(pos)
 		
 		self.cache[pos - self.cachepos].Delete()
 		del self.cache[pos - self.cachepos]
+		
+		if self.randomlist:
+			del self.randomlist[pos]
+		
 		self.length	-=	1
 		return self
 		
 	# -------------------------------------------------------------------
+	# Moving backwards loads the window which ends at pos so that paging
+	# back through the list is as cheap as paging forwards.
 	def _RefreshCache(self, pos):
+		if self.cache and pos < self.cachepos:
+			start	=	max(0, pos - self.cachesize + 1)
+		else:
+			start	=	pos
+		
+		if self.randomlist:
+			self._RefreshRandom(start)
+			return
+		
+		if self.keyset and self.cache:
+			first	=	self.cachepos
+			last	=	self.cachepos + len(self.cache) - 1
+			rows	=	None
+			
+			if pos > last:
+				rows	=	self._Seek(self.cache[-1], True, pos - last - 1, self.cachesize)
+				
+				# A short window is only right at the end of the list
+				if rows != None and len(rows) < self.cachesize and start + len(rows) < len(self):
+					rows	=	None
+			elif pos < first and first - pos < pos:
+				rows	=	self._Seek(self.cache[0], False, first - 1 - pos, pos - start + 1)
+				
+				if rows != None and len(rows) == pos - start + 1:
+					rows.reverse()
+				else:
+					rows	=	None
+			
+			if rows:
+				self.cache		=	rows
+				self.cachepos	=	start
+				return
+		
 		query	=	''
 		
 		if self.filter:
 			query	=	query + self.filter
 			
-		if self.orderby:
-			query	=	query + ' ORDER BY ' + self.orderby
+		if self.order:
+			query	=	query + ' ORDER BY ' + self.order
 		
-		if self.randomlist:
-			query	=	query + ' LIMIT {}, 1'.format(pos)
-		else:
-			query	=	query + ' LIMIT {}, {}'.format(pos, self.cachesize)
+		query	=	query + ' LIMIT {}, {}'.format(start, self.cachesize)
 		
 		self.cache		=	self.obj.Find(query, self.params)
-		self.cachepos	=	pos
+		self.cachepos	=	start
 		
 	# -------------------------------------------------------------------
+	# Loads the whole window of shuffled ids starting at start with one
+	# query. Ids which have disappeared since SetRandom() are dropped
+	# and the window is loaded again so that positions stay contiguous.
+	def _RefreshRandom(self, start):
+		while True:
+			ids		=	self.randomlist[start:start + self.cachesize]
+			objs	=	{}
+			
+			if ids:
+				for o in self.obj.Find(
+						'WHERE id IN ({})'.format(', '.join(['?' for id in ids])), 
+						list(ids)
+					):
+					objs[o.id]	=	o
+			
+			if len(objs) == len(ids):
+				break
+			
+			for i in reversed(range(0, len(ids))):
+				if ids[i] not in objs:
+					del self.randomlist[start + i]
+		
+		self.length		=	len(self.randomlist)
+		self.cache		=	[objs[id] for id in ids]
+		self.cachepos	=	start
+		
+	# -------------------------------------------------------------------
+	# Shuffles the ids of the filtered rows once, keeping them in a
+	# compact array instead of a list of Python ints.
 	def SetRandom(self, active):
+		self.cache	=	[]
+		
 		if active:
-			self.randomlist	=	list(range(0, self.Count()))
+			table	=	self.obj._Table()
+			
+			self.randomlist	=	array.array('q', [
+				r[0] for r in self.obj._DB().IterQuery(
+					'SELECT {}.id FROM {} {}'.format(table, table, self.filter), 
+					self.params
+				)
+			])
 			random.shuffle(self.randomlist)
+			self.length	=	len(self.randomlist)
 		else:
-			self.randomlist	=	[]
+			self.randomlist	=	array.array('q')
+			self.Count()